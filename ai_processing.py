@@ -1,8 +1,17 @@
 
+import io
 import os
-import json 
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json_repair
+from PIL import Image, ImageOps
+from pydantic import BaseModel, ValidationError
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 # import streamlit as st is removed here to prevent conflicts
 
 # --- Helper Function for Reliable Key Retrieval ---
@@ -11,96 +20,248 @@ def get_gemini_api_key():
     # We now ONLY check the operating system's environment variable
     return os.getenv('GEMINI_API_KEY')
 
-# --- 2. AI STEP 1: IDENTIFY INGREDIENTS (DIRECT OS ENV INJECTION) ---
-def identify_ingredients(uploaded_file):
-    api_key = get_gemini_api_key()
-    if not api_key:
-        # User-facing error message now confirms the key is missing from the environment
-        return "Error: Gemini API key is missing from the environment variables."
-    
-    try:
-        # Inject the key directly from the environment
-        client = genai.Client(api_key=api_key) 
-    except Exception as e:
-        print(f"Error during client initialization: {e}")
-        return "Error: AI client failed to initialize with key."
-
-    image_bytes = uploaded_file.getvalue()
-    
-    image_part = types.Part.from_bytes(
-        data=image_bytes,
-        mime_type=uploaded_file.type
-    )
-
-    prompt = """
-    You are an expert food inventory specialist. Analyze the provided image.
-    List every distinct food item and estimate the quantity or amount.
-    Output ONLY a Python list of strings. Do not include any introductory or
-    explanatory text.
-    
-    If the image contains absolutely no discernible food ingredients, 
-    output the exact phrase: FAILURE: NO FOOD DETECTED
-    
-    Example format: ['3 large tomatoes', '1/2 red onion', '1 block of feta cheese', 'handful of basil leaves']
-    """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[image_part, prompt]
-        )
-        response_text = response.text.strip().replace("```python", "").replace("```", "")
-        return response_text
-    except Exception as e:
-        print(f"Error during ingredient identification: {e}")
-        return f"Error during API call: {e}"
-
-# --- 3. AI STEP 2 & SCRIPT GENERATION: GENERATE RECIPE (DIRECT OS ENV INJECTION) ---
-def generate_recipe(ingredient_list_str, cuisine, max_time, dietary_filters):
-    api_key = get_gemini_api_key()
-    if not api_key:
-        return '{"error": "AI client not initialized."}'
-        
-    try:
-        client = genai.Client(api_key=api_key) 
-    except Exception as e:
-        print(f"Error during client initialization: {e}")
-        return '{"error": "AI client failed to initialize with key."}'
-
-
-    if "FAILURE: NO FOOD DETECTED" in ingredient_list_str:
-        return '{"error": "Ingredient identification failed. No food was detected in the image."}'
-        
-    constraints = f"""
+# --- Prompt Text (built once at import) ---
+CONSTRAINTS_TEMPLATE = """
     Constraints:
     * **Cuisine:** {cuisine}
-    * **Dietary:** {', '.join(dietary_filters) if dietary_filters else 'None'}
+    * **Dietary:** {dietary}
     * **Max Prep Time:** {max_time} minutes.
     """
 
-    prompt = f"""
-    You are a professional, creative recipe developer. Your task is to generate one unique,
-    easy-to-follow recipe using ONLY the ingredients listed below.
-    Assume the user has salt, pepper, and standard cooking oil.
+# Static instructions, sent as the system instruction so each request only carries
+# the photo and the constraints block.
+RECIPE_INSTRUCTIONS = """
+    You are an expert food inventory specialist and a professional, creative recipe developer.
 
-    **Ingredients:** {ingredient_list_str}
+    Step 1: Analyze the provided image. Identify every distinct food item and estimate the
+    quantity or amount.
 
-    **{constraints}**
+    Step 2: Generate one unique, easy-to-follow recipe using ONLY the ingredients you identified.
+    Assume the user has salt, pepper, and standard cooking oil. Follow the constraints given
+    with the image.
 
-    Format: Present the output in a JSON format. Do not include any other text besides the JSON object.
-    Keys must include: `title`, `description`, `cuisine`, `prep_time_minutes`, `ingredients_used` (a list of strings), `instructions` (a list of strings), and a new key, **`narration_script`** (a single string containing a voiceover script summarizing the instructions in a cheerful, clear tone).
+    Format: Fill in every field of the response schema. `ingredients_used` lists each ingredient
+    with its estimated quantity, and `narration_script` is a single string containing a voiceover
+    script summarizing the instructions in a cheerful, clear tone.
     Ensure `prep_time_minutes` adheres to the max time constraint.
+
+    If the image contains absolutely no discernible food ingredients, return an empty
+    `ingredients_used` list and leave the other text fields empty.
     """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[prompt]
+
+# --- Response Schema ---
+class Recipe(BaseModel):
+    """The recipe JSON the model is constrained to return."""
+    title: str
+    description: str
+    cuisine: str
+    prep_time_minutes: int
+    ingredients_used: list[str]
+    instructions: list[str]
+    narration_script: str
+
+RECIPE_CONFIG = types.GenerateContentConfig(
+    system_instruction=RECIPE_INSTRUCTIONS,
+    response_mime_type="application/json",
+    response_schema=Recipe
+)
+
+# --- Shared Client and Event Loop ---
+# One client per process keeps its HTTP connection pool (and TLS sessions) warm
+# across calls. Its async transport is bound to the loop it first runs on, so all
+# coroutines are scheduled on one long-lived background loop via run_async().
+_client = None
+_client_lock = threading.Lock()
+
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="gemini-event-loop", daemon=True).start()
+
+# Caps in-flight Gemini requests across all sessions (they share the loop above),
+# so simultaneous clicks queue here instead of tripping the per-minute quota.
+_GEMINI_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "4")))
+
+def get_client():
+    """Returns the process-wide Gemini client, or None if the API key is missing."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key = get_gemini_api_key()
+            if api_key:
+                _client = genai.Client(api_key=api_key)
+    return _client
+
+def run_async(coro):
+    """Schedules a coroutine on the shared event loop and returns a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+# --- Retry Policy for Gemini Calls ---
+def is_retryable_error(exc):
+    """Rate limits (429) and server-side failures (5xx) are transient; bad requests and auth errors are not."""
+    return isinstance(exc, errors.APIError) and (exc.code == 429 or (exc.code or 0) >= 500)
+
+# Exponential backoff with jitter; after the last attempt the original error is re-raised.
+gemini_retry = retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable_error),
+    reraise=True
+)
+
+@gemini_retry
+async def _open_gemini_stream(client, contents, config=None):
+    """Starts a streamed call and waits for its first chunk, so quota and server errors surface inside the retry."""
+    stream = await client.aio.models.generate_content_stream(
+        model='gemini-2.5-flash',
+        contents=contents,
+        config=config
+    )
+    first_chunk = await anext(stream)
+    return first_chunk, stream
+
+# --- Response Caches (keyed by content hash, process-wide) ---
+class LRUCache:
+    """A small dict-like cache that evicts the least recently used entry past `maxsize`."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+# Re-uploading the same photo or re-clicking "Generate" reuses the earlier
+# answer instead of paying for another API call. Errors are never cached.
+# Both caches are shared by every session (and only touched from the shared
+# event loop), so they are bounded to keep a long-running app's memory flat.
+_recipe_cache = LRUCache(maxsize=128)
+
+# Gemini Files API handles for uploaded photos, keyed by content hash. Files live
+# server-side for ~48h, so retries and repeat calls reference the URI instead of
+# re-sending the image bytes.
+_uploaded_files = LRUCache(maxsize=64)
+
+def content_hash(data):
+    """Returns a stable hex digest for raw bytes or text, used as a cache key."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data).hexdigest()
+
+def prepare_image(image_bytes, max_side=1024):
+    """Shrinks the photo to at most `max_side` px on its longest edge and re-encodes it as JPEG."""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    img.thumbnail((max_side, max_side))
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue()
+
+@gemini_retry
+async def upload_image(client, image_bytes, mime_type, cache_key):
+    """Uploads the image through the Files API once and reuses the handle until it expires."""
+    uploaded = _uploaded_files.get(cache_key)
+    if uploaded is not None and uploaded.expiration_time and uploaded.expiration_time <= datetime.now(timezone.utc):
+        uploaded = None
+    if uploaded is None:
+        uploaded = await client.aio.files.upload(
+            file=io.BytesIO(image_bytes),
+            config=types.UploadFileConfig(mime_type=mime_type)
         )
-        return response.text.strip().replace("```json", "").replace("```", "")
+        _uploaded_files.set(cache_key, uploaded)
+    return uploaded
+
+# --- 2. AI STEPS 1 & 2: IDENTIFY INGREDIENTS AND GENERATE RECIPE IN ONE CALL ---
+def build_constraints(cuisine, max_time, dietary_filters):
+    """Builds the constraints block of the recipe prompt."""
+    return CONSTRAINTS_TEMPLATE.format(
+        cuisine=cuisine,
+        dietary=', '.join(dietary_filters) if dietary_filters else 'None',
+        max_time=max_time
+    )
+
+async def generate_recipe(image_bytes, mime_type, constraints, image_key=None):
+    """Streams the recipe JSON text chunk by chunk (errors arrive as a single JSON chunk)."""
+    image_key = image_key or content_hash(image_bytes)
+    cache_key = (image_key, constraints)
+    cached_recipe = _recipe_cache.get(cache_key)
+    if cached_recipe is not None:
+        yield cached_recipe
+        return
+
+    try:
+        client = get_client()
+    except Exception as e:
+        print(f"Error during client initialization: {e}")
+        yield '{"error": "AI client failed to initialize with key."}'
+        return
+    if client is None:
+        # User-facing error message now confirms the key is missing from the environment
+        yield '{"error": "Gemini API key is missing from the environment variables."}'
+        return
+
+    chunks = []
+    try:
+        async with _GEMINI_SEM:
+            image_file = await upload_image(client, image_bytes, mime_type, image_key)
+            first_chunk, stream = await _open_gemini_stream(client, [image_file, constraints], RECIPE_CONFIG)
+            if first_chunk.text:
+                chunks.append(first_chunk.text)
+                yield first_chunk.text
+            async for chunk in stream:
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
     except Exception as e:
         print(f"Error during recipe generation: {e}")
-        return '{"error": "Recipe generation failed due to API error."}'
+        if not chunks:
+            yield '{"error": "Recipe generation failed due to API error."}'
+        return
+    # Only a complete, schema-valid response is worth replaying; empty, truncated or
+    # blocked streams stay uncached so a retry makes a fresh call.
+    recipe_json_str = "".join(chunks)
+    try:
+        Recipe.model_validate_json(recipe_json_str)
+    except ValidationError:
+        return
+    _recipe_cache.set(cache_key, recipe_json_str)
+
+def iterate_async(agen):
+    """Drives an async generator on the shared event loop, yielding its items synchronously."""
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__()).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose()).result()
+
+# --- Helpers for Parsing Streamed Recipe JSON ---
+def parse_recipe(text):
+    """Validates the streamed JSON against `Recipe`; failures come back as an {"error": ...} dict."""
+    try:
+        recipe = Recipe.model_validate_json(text)
+    except ValidationError:
+        # Either an error object from generate_recipe or a stream that was cut off.
+        data = json_repair.loads(text)
+        if isinstance(data, dict) and data.get("error"):
+            return data
+        return {"error": "The AI response was incomplete. Please try again."}
+    if not recipe.ingredients_used:
+        return {"error": "No discernible food items were detected in your image."}
+    return recipe.model_dump()
+
+def extract_partial_recipe(buffer):
+    """Best-effort parse of an incomplete JSON buffer (open strings and brackets are closed)."""
+    data = json_repair.loads(buffer)
+    return data if isinstance(data, dict) else {}
 
 
 # --- 4. MOCK AI STEP 3: VIDEO GENERATION ---
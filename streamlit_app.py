@@ -1,8 +1,10 @@
 
 import streamlit as st
-import json
-import ast
-from ai_processing import identify_ingredients, generate_recipe, generate_recipe_video
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+from ai_processing import (
+    build_constraints, content_hash, prepare_image, generate_recipe, generate_recipe_video,
+    iterate_async, parse_recipe, extract_partial_recipe
+)
 
 # --- 1. SET UP THE PAGE AND THEME ---
 st.set_page_config(
@@ -12,7 +14,7 @@ st.set_page_config(
 )
 
 # NEW: CSS STYLING WITH BACKGROUND COLOR CHANGES
-st.markdown("""
+_CSS = """
 <style>
 /* 5. PAGE BACKGROUND COLOR (New Addition) */
 /* Targets the overall app background (main content area) */
@@ -55,7 +57,12 @@ div[data-testid="stAlert"] {
     box-shadow: 2px 2px 8px rgba(0, 0, 0, 0.1); 
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Emitted on every run: Streamlit drops any element a rerun doesn't re-emit, so a
+# one-time injection would lose the styling after the first interaction. Keeping
+# the string constant lets the frontend see an unchanged element and skip re-rendering it.
+st.markdown(_CSS, unsafe_allow_html=True)
 
 
 st.title("📸 AI Recipe Recommender")
@@ -104,57 +111,73 @@ if 'recipe_data' not in st.session_state:
     st.session_state.narration_script = None
 
 # --- A. Recipe Generation Logic ---
-if generate_button and uploaded_file is not None:
-    st.info("Step 1: Analyzing Ingredients...")
+@st.cache_data(show_spinner=False, max_entries=32, hash_funcs={UploadedFile: lambda f: f.file_id})
+def _prep_image(file):
+    """Reads, hashes and downscales an upload once per file; later reruns reuse the result."""
+    image_bytes = file.getvalue()
+    # A downscaled JPEG is all the model needs, and is a fraction of a phone photo's size.
+    return content_hash(image_bytes), prepare_image(image_bytes), "image/jpeg"
+
+def run_generation_workflow():
+    try:
+        image_key, jpeg_bytes, mime_type = _prep_image(uploaded_file)
+    except OSError:
+        # Covers PIL.UnidentifiedImageError: the uploader only checks the file extension.
+        st.error("❌ Could not read this image. Please upload a valid JPG or PNG photo.")
+        st.session_state.recipe_data = None
+        return
+    constraints = build_constraints(cuisine, max_time, dietary_filters)
+
+    st.info("Analyzing your ingredients and generating a personalized recipe...")
     
     col1, col2 = st.columns([1, 2]) 
     
     with col1:
-        st.image(uploaded_file, caption="Uploaded Ingredients", use_container_width=True) 
+        st.image(jpeg_bytes, caption="Uploaded Ingredients", use_container_width=True) 
     
     with col2:
-        with st.spinner('Analyzing your photo and detecting food items...'):
-            ingredient_list_str = identify_ingredients(uploaded_file) 
+        # Show the title and description as soon as they stream in, while the instructions are still generating.
+        preview = st.empty()
+        recipe_json_str = ""
+        with st.spinner('Detecting food items and crafting the perfect dish based on your constraints...'):
+            for chunk in iterate_async(generate_recipe(jpeg_bytes, mime_type, constraints, image_key)):
+                recipe_json_str += chunk
+                partial = extract_partial_recipe(recipe_json_str)
+                if partial.get('title'):
+                    preview.markdown(f"**{partial['title']}**\n\n> *{partial.get('description', '...')}*")
+        preview.empty()
     
-    if ingredient_list_str and "FAILURE: NO FOOD DETECTED" in ingredient_list_str:
-        st.error("❌ Ingredient identification failed. No discernible food items were detected in your image.")
+    recipe_data = parse_recipe(recipe_json_str)
+    if 'error' in recipe_data:
+        st.error(f"❌ {recipe_data['error']}")
         st.session_state.recipe_data = None
-    elif "Error" in ingredient_list_str:
-         st.error(f"A technical error occurred during ingredient identification. Details: {ingredient_list_str}")
-         st.session_state.recipe_data = None
-    elif ingredient_list_str:
-        
-        st.success("✅ Ingredients Identified. Starting Recipe Generation...")
-        
-        with st.expander("📝 View Identified Ingredients"):
-            try:
-                clean_list = ast.literal_eval(ingredient_list_str)
-                st.markdown("\n".join([f"- **{i}**" for i in clean_list]))
-            except:
-                st.code(ingredient_list_str) 
-
-
-        st.info("Step 2: Generating Personalized Recipe...")
-        with st.spinner('Crafting the perfect dish based on your constraints...'):
-            recipe_json_str = generate_recipe(
-                ingredient_list_str, 
-                cuisine, 
-                max_time, 
-                dietary_filters
-            )
-        
-        try:
-            recipe_data = json.loads(recipe_json_str) 
-            st.session_state.recipe_data = recipe_data # Store data
-            st.session_state.narration_script = recipe_data.get('narration_script', 'No script generated.')
-
-        except json.JSONDecodeError:
-            st.error("Error: Could not parse the recipe. The AI did not return a valid JSON structure.")
-            with st.expander("View Raw AI Output (for debugging)"):
-                 st.code(recipe_json_str)
-            st.session_state.recipe_data = None
-
-# --- B. Display Recipe and Video Button ---
+        return
+
+    st.success("✅ Ingredients Identified and Recipe Generated!")
+    
+    with st.expander("📝 View Identified Ingredients"):
+        st.markdown("\n".join(f"- **{i}**" for i in recipe_data.get('ingredients_used', [])))
+
+    st.session_state.recipe_data = recipe_data # Store data
+    st.session_state.narration_script = recipe_data.get('narration_script', 'No script generated.')
+    # The video step is a constant-return mock, so resolve it now and render it in this same run.
+    st.session_state.video_url = generate_recipe_video(recipe_data.get('title'), st.session_state.narration_script)
+
+if generate_button and uploaded_file is not None:
+    run_generation_workflow()
+
+# --- B. Display Recipe and Video ---
+@st.fragment
+def video_section(data):
+    """Renders the video card; widgets added here rerun only this block, not the whole page."""
+    st.subheader("🎥 Step 3: AI-Generated Video Instructions")
+    
+    if st.session_state.video_url:
+        st.info("Enjoy this video if you do not know where to start cooking ")
+        st.video(st.session_state.video_url)
+        with st.expander("View AI Narration Script"):
+            st.code(data.get('narration_script', 'No script generated.'))
+
 if st.session_state.recipe_data:
     data = st.session_state.recipe_data
 
@@ -174,33 +197,16 @@ if st.session_state.recipe_data:
     with final_col1:
         st.subheader("Ingredients Used")
         ingredients_list = data.get('ingredients_used', [])
-        st.markdown("\n".join([f"**•** {i}" for i in ingredients_list]))
+        st.markdown("\n".join(f"**•** {i}" for i in ingredients_list))
         
     with final_col2:
         st.subheader("Instructions")
         instructions_list = data.get('instructions', [])
-        for i, step in enumerate(instructions_list):
-            st.markdown(f"**{i+1}.** {step}")
+        # One markdown element (an ordered list) instead of one element per step.
+        st.markdown("\n".join(f"{i+1}. {step}" for i, step in enumerate(instructions_list)))
 
     st.markdown("---") 
-    st.subheader("🎥 Step 3: AI-Generated Video Instructions")
-    
-    # New Video Generation Button
-    video_button = st.button("Generate Video Instructions", key="video_gen_btn", type="secondary")
-    
-    if video_button:
-        with st.spinner("Calling Text-to-Video API..."):
-            # Call the mock function
-            video_url = generate_recipe_video(data.get('title'), st.session_state.narration_script)
-            st.session_state.video_url = video_url
-            
-            st.success("Video link generated!")
-            
-    if st.session_state.video_url:
-        st.info("Enjoy this video if you do not know where to start cooking ")
-        st.video(st.session_state.video_url)
-        with st.expander("View AI Narration Script"):
-            st.code(st.session_state.narration_script)
+    video_section(data)
 
 elif generate_button:
     st.warning("Please upload an image before generating a recipe.")